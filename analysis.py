@@ -28,6 +28,7 @@ So lets start with smaller goals.
 1) Given a stock, compare its performance with its peers.
 
 """
+import asyncio
 import numpy as np
 import pandas as pd
 import os
@@ -35,6 +36,8 @@ import logging
 import sys
 import argparse
 import pdb
+import warnings
+from functools import lru_cache
 
 # local module
 from iex_api import IEXApi
@@ -45,10 +48,13 @@ class Analysis():
     This Object will be used to retrieve data from the API and perform Analysis based on the data received
     """
 
+    _MOMENTUM_COLS = ['month1ChangePercent', 'month3ChangePercent', 'month6ChangePercent', 'year1ChangePercent']
+
     def __init__(self, api: IEXApi = None) -> None:
         if api is None:
             api = IEXApi(token=api_token, base_url=base_url, logger=logger)
         self.api_obj = api
+        self._sectors = None
 
     def momentum_analysis(self, stats_df: pd.DataFrame) -> pd.DataFrame:
         """
@@ -61,26 +67,80 @@ class Analysis():
             DataFrame: Momentum DataFrame w/ percent changes, respective percentiles, and an averaged percentile.
         """
 
-        mom_df = stats_df[['symbol', 'month1ChangePercent',
-                           'month3ChangePercent', 'month6ChangePercent', 'year1ChangePercent']]
+        cols = self._MOMENTUM_COLS
+        values = stats_df[cols].to_numpy(dtype=np.float64)
 
         # calculate percentiles for each stock over their respective timeframes
-        for time in mom_df.iloc[:, 1:5].columns:
-            mom_df[time+"_tile"] = mom_df[time].rank(pct=True)
+        tiles = self._rank_pct(values)
+
+        # average the percentiles, stocks w/o any change percent stay NaN w/o a "Mean of empty slice" warning
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            avg_tiles = np.nanmean(tiles, axis=1)
+
+        # assemble the output once rather than adding columns to a slice of stats_df
+        return pd.DataFrame({'symbol': stats_df['symbol'].values,
+                             **{col: values[:, i] for i, col in enumerate(cols)},
+                             **{col + "_tile": tiles[:, i] for i, col in enumerate(cols)},
+                             'avgPercentiles': avg_tiles},
+                            index=stats_df.index)
+
+    def _rank_pct(self, values: np.ndarray) -> np.ndarray:
+        """
+        Percentile rank of each value within its column, computed in double precision.
+
+        Matches pd.Series.rank(pct=True): ties share their average rank and missing values stay NaN,
+        w/o the precision issues pandas has on very large columns. A unique largest value ranks exactly 1.0.
+
+        Args:
+            values (np.ndarray): 2-D float array, one column per statistic.
+
+        Returns:
+            np.ndarray: Array of the same shape w/ percentiles in (0, 1].
+        """
+        tiles = np.full(values.shape, np.nan)
+        for i in range(values.shape[1]):
+            finite = np.isfinite(values[:, i])
+            column = values[finite, i]
+            ordered = np.sort(column)
+            low = np.searchsorted(ordered, column, side='left')
+            high = np.searchsorted(ordered, column, side='right')
+            tiles[finite, i] = (low + high + 1) / (2.0 * ordered.size)
+        return tiles
+
+    def peer_percentiles(self, stats_df: pd.DataFrame, cols: list[str],
+                         qs: tuple[float, ...] = (25, 50, 75, 90)) -> pd.DataFrame:
+        """
+        Percentiles of the given statistics across the stocks listed in stats_df (e.g. P/E, debt/equity).
+
+        Args:
+            stats_df (pd.DataFrame): DataFrame containing the statistics for each stock
+            cols (list[str]): Statistics to summarize.
+            qs (tuple[float, ...], optional): Percentiles to compute. Defaults to (25, 50, 75, 90).
 
-        # get all the percentile columns and average them
-        mom_df['avgPercentiles'] = mom_df[[
-            col for col in mom_df.columns if "_tile" in col]].mean(axis=1)
+        Returns:
+            pd.DataFrame: DataFrame w/ one row per percentile and one column per statistic.
+        """
+        return pd.DataFrame(self._multi_percentile(stats_df, cols, qs), index=list(qs), columns=cols)
 
-        return mom_df
+    def _multi_percentile(self, df: pd.DataFrame, cols: list[str], qs: list[float]) -> np.ndarray:
+        """
+        Compute every requested percentile of every column in a single call, ignoring missing values.
 
+        Args:
+            df (pd.DataFrame): DataFrame containing the columns of interest.
+            cols (list[str]): Columns to compute percentiles of.
+            qs (list[float]): Percentiles to compute, between 0 and 100.
+
+        Returns:
+            np.ndarray: Array of shape (len(qs), len(cols)).
+        """
+        values = df[cols].to_numpy(dtype=np.float64)
+        return np.nanpercentile(values, qs, axis=0)
 
     def get_symbol_info(self, symbols:list[str]) -> pd.DataFrame:
         data = self.api_obj.get_symbol_info(symbols=symbols)
-        data_df = pd.DataFrame.from_dict(data.json()).transpose()
-        data_df = pd.merge(data_df, data_df['company'].apply(pd.Series), left_index=True, right_index=True)
-        data_df = data_df.drop('company', axis=1)
-        return data_df
+        return self._flatten_batch(data, 'company')
 
     def get_sectors(self) -> pd.DataFrame:
         """
@@ -89,20 +149,57 @@ class Analysis():
         Returns:
             pd.DataFrame: [description]
         """
-        sectors = self.api_obj.get_sector_list()
-        sectors_df = pd.DataFrame.from_dict(sectors.json())
+        sectors_df = pd.DataFrame.from_dict(self._sectors_cached())
         return sectors_df
 
+    def _sectors_cached(self) -> list[dict]:
+        """
+        Sector list from the API, memoized on the instance since IEX only updates it about once a day.
+
+        Returns:
+            list[dict]: JSON returned by API, one dict per sector.
+        """
+        if self._sectors is None:
+            self._sectors = self.api_obj.get_sector_list()
+        return self._sectors
+
     def get_sector_quotes(self, sector):
         sector_quotes = self.api_obj.get_sector_quotes(sector)
         pdb.set_trace()
         print("here")
 
-    def get_peers(self, symbols):
-        _req = self.api_obj._create_request(
-            symbols=symbols, data_set=['peers'])
-        data = self.api_obj._send_request(request=_req)
-        return pd.DataFrame.from_dict(data.json()).transpose()
+    def get_peers(self, symbols: list[str]) -> pd.DataFrame:
+        """
+        Return the peers of each symbol.
+
+        Args:
+            symbols (list[str]): list of symbols
+
+        Returns:
+            pd.DataFrame: DataFrame w/ a symbol and a peers column, each row is a symbol.
+        """
+        data = self.api_obj.get_peers(symbols)
+        return self._peers_frame(data)
+
+    def bulk(self, symbols: list[str]) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        """
+        Fetch info, peers and simple statistics of the symbols concurrently, so the wait is the slowest request not the sum.
+
+        Args:
+            symbols (list[str]): list of symbols
+
+        Returns:
+            tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]: Same DataFrames as get_symbol_info, get_peers and get_symbol_stats.
+        """
+        return asyncio.run(self._bulk(symbols))
+
+    async def _bulk(self, symbols: list[str]) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+        # one session for the three batches, so they share the API's concurrency limit
+        async with self.api_obj._batch_session() as batch_session:
+            info, peers, stats = await asyncio.gather(self.api_obj.get_symbol_info_async(symbols, batch_session),
+                                                      self.api_obj.get_peers_async(symbols, batch_session),
+                                                      self.api_obj.get_stats_async(symbols, batch_session))
+        return self._flatten_batch(info, 'company'), self._peers_frame(peers), self._flatten_batch(stats, 'stats')
 
     def get_advanced_symbol_stats(self, symbols:list[str])->pd.DataFrame:
         """
@@ -115,13 +212,7 @@ class Analysis():
             pd.DataFrame: DataFrame containing statistics, each row is a symbol
         """
         data = self.api_obj.get_advanced_stats(symbols)
-        data_df = pd.DataFrame.from_dict(data.json()).transpose()
-        data_df['symbol'] = data_df.index
-        data_df = data_df.reset_index(drop=True)
-        data_df = pd.merge(
-            data_df, data_df['advanced-stats'].apply(pd.Series), left_index=True, right_index=True)
-        data_df = data_df.drop('advanced-stats', axis=1)
-        return data_df
+        return self._flatten_batch(data, 'advanced-stats')
 
     def get_symbol_stats(self, symbols: list[str]) -> pd.DataFrame:
         """
@@ -134,12 +225,56 @@ class Analysis():
             pd.DataFrame: DataFrame containing statistics, each row is a symbol.
         """
         data = self.api_obj.get_stats(symbols)
-        data_df = pd.DataFrame.from_dict(data.json()).transpose()
-        data_df['symbol'] = data_df.index
-        data_df = data_df.reset_index(drop=True)
-        data_df = pd.merge(data_df, data_df['stats'].apply(
-            pd.Series), left_index=True, right_index=True)
-        data_df = data_df.drop('stats', axis=1)
+        return self._flatten_batch(data, 'stats')
+
+    def get_symbol_stats_subset(self, symbols: list[str], fields: list[str] = None) -> pd.DataFrame:
+        """
+        Return a subset of the simple statistics given a list of symbols, w/o holding the full responses in memory.
+
+        Args:
+            symbols (list[str]): list of symbols
+            fields (list[str], optional): Statistics to keep. Defaults to the columns used by momentum_analysis.
+
+        Returns:
+            pd.DataFrame: DataFrame w/ a symbol column and one column per field, each row is a symbol.
+        """
+        if fields is None:
+            fields = self._MOMENTUM_COLS
+        data = self.api_obj.get_stats_subset(symbols, fields)
+        return pd.DataFrame({**data, 'symbol': pd.Categorical(data['symbol'])})
+
+    def _flatten_batch(self, data: dict, data_set: str) -> pd.DataFrame:
+        """
+        Flatten a batch response into a DataFrame in a single pass, unpacking the nested data_set.
+
+        Args:
+            data (dict): JSON returned by a batch request, keyed by symbol.
+            data_set (str): Nested data set to unpack into columns (e.g. stats, advanced-stats, company).
+
+        Returns:
+            pd.DataFrame: DataFrame w/ a categorical symbol column, each row is a symbol.
+        """
+        records = [{'symbol': symbol,
+                    **{key: value for key, value in values.items() if key != data_set},
+                    **(values.get(data_set) or {})}
+                   for symbol, values in data.items()]
+        data_df = pd.DataFrame(records)
+        # built from the keys rather than the column, so an empty batch still gets a symbol column
+        data_df['symbol'] = pd.Categorical(list(data))
+        return data_df
+
+    def _peers_frame(self, data: dict) -> pd.DataFrame:
+        """
+        Build the peers DataFrame row-wise from a batch response.
+
+        Args:
+            data (dict): JSON returned by a peers batch request, keyed by symbol.
+
+        Returns:
+            pd.DataFrame: DataFrame w/ a categorical symbol column and a peers column, each row is a symbol.
+        """
+        data_df = pd.DataFrame([{'symbol': symbol, **values} for symbol, values in data.items()])
+        data_df['symbol'] = pd.Categorical(list(data))
         return data_df
 
     def stream_data(self, symbols):
@@ -147,6 +282,22 @@ class Analysis():
         return data
 
 
+@lru_cache(maxsize=None)
+def load_portfolio(path: str) -> tuple[str, ...]:
+    """
+    Parse the portfolio file once, uppercasing and de-duplicating symbols so no API quota is wasted.
+
+    Args:
+        path (str): Whitespace separated file of symbols.
+
+    Returns:
+        tuple[str, ...]: Sorted unique symbols, sorting keeps the batch chunks (and their cache entries) stable.
+    """
+    with open(path, 'r') as f:
+        content = f.read()
+    return tuple(sorted({symbol.upper() for symbol in content.split()}))
+
+
 def load_env(mode="SandBox", logger=None):
     """
     Load environment variables to ensure security of user.
@@ -177,9 +328,7 @@ def load_env(mode="SandBox", logger=None):
         base_url = "https://cloud.iexapis.com"
 
     # load in portfolio investments
-    with open("portfolio.txt", 'r') as f:
-        content = f.read()
-    portfolio_symbols = content.split()
+    portfolio_symbols = list(load_portfolio("portfolio.txt"))
     logger.info("Loaded Portfolio")
 
     return api_token, base_url, portfolio_symbols
@@ -197,11 +346,10 @@ def main(token=None, base_url=None, portfolio_symbols=None, logger=None):
     # astats_df = anal_obj.get_advanced_symbol_stats(symbols=portfolio_symbols)
 
     # todo
-    df = anal_obj.get_symbol_info(symbols=["NVDA", "PLTR"])
-    print(df)
+    info_df, peers_df, stats_df = anal_obj.bulk(symbols=portfolio_symbols)
+    print(info_df)
 
     # sector_quotes = anal_obj.get_sector_quotes("Semiconductors")
-    # anal_obj.get_peers(symbols=["NVDA", "CRSP"])
     # stream = anal_obj.stream_data("ATVI")
     # pdb.set_trace()
 
@@ -1,9 +1,23 @@
 import sys
+import asyncio
+import aiohttp
+import yarl
+import orjson
+import ijson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pdb
 import logging
 import os
+import hashlib
+import shelve
+import time
+from array import array
+from itertools import islice
+from contextlib import asynccontextmanager
 from typing import Union
+from urllib.parse import urlencode
 
 
 class IEXApi():
@@ -11,9 +25,19 @@ class IEXApi():
     Object to interact with the API. Requires an account at https://iexcloud.io/
     """
 
+    # joined data sets, shared by every chunk of a batch request
+    _INFO_TYPES = "company"
+    _STAT_TYPES = "stats,price"
+    _ADV_STAT_TYPES = "advanced-stats"
+    _PEER_TYPES = "peers"
+    _SUBSET_TYPES = "stats"
+
     def __init__(self,
                  token: Union[str, None] = os.getenv("IEX_CLOUD_TOKEN_SAND"),
                  base_url: Union[str, None] = "https://sandbox.iexapis.com",
+                 cache_path: Union[str, None] = "iex_cache",
+                 max_concurrency: int = 10,
+                 max_retries: int = 3,
                  logger=None):
         """
         Class to interact with IEX Cloud API.
@@ -21,32 +45,63 @@ class IEXApi():
         Args:
             token (Union[str,None], optional): Personal Token required to interact with API. Defaults to os.getenv("IEX_CLOUD_TOKEN_SAND").
             base_url (Union[str,None], optional): Base URL to send requests. Defaults to "https://sandbox.iexapis.com".
+            cache_path (Union[str,None], optional): File used to cache responses on disk, None disables caching. Defaults to "iex_cache".
+            max_concurrency (int, optional): Maximum number of requests in flight at once. Defaults to 10.
+            max_retries (int, optional): Retries of a rate limited (429) request, and of 5xx responses on self.session. Defaults to 3.
             logger (logging.Logger, optional): Logger to be used within the class. Defaults to None.
+
+        Raises:
+            ValueError: If no token is given, e.g. IEX_CLOUD_TOKEN_SAND/IEX_CLOUD_TOKEN is not set.
         """
 
         if logger is None:
             logger = logging.getLogger(__name__)
 
+        # every request carries the token as a query parameter, fail here rather than w/ an unauthenticated request
+        if not token:
+            raise ValueError("No IEX Cloud token, set IEX_CLOUD_TOKEN_SAND/IEX_CLOUD_TOKEN or pass token=")
+
         self.logger = logger
         self.token = token
         self.base_url = base_url
+        self.cache_path = cache_path
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+        # request_type -> URL builder used by self._create_request()
+        self._builders = {'stat': self._build_batch_url,
+                          'info': self._build_batch_url,
+                          'sector_list': self._build_sector_url}
+
+        # keep the connection to the API open across requests, and retry transient errors w/ backoff
+        retries = Retry(total=max_retries, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                        raise_on_status=False)
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries))
+        # compressed responses are already negotiated, requests.Session sends Accept-Encoding: gzip, deflate by default
+
         self.logger.info(f"Loaded API w/ base_url = {self.base_url}")
 
-    def get_symbol_info(self, symbols: list[str]) -> requests.Response:
+    def get_symbol_info(self, symbols: list[str]) -> dict:
         """
-        Get general information about the symbol.
+        Get general information about the symbols.
 
         Args:
-            symbol (str): Symbol of interest.
+            symbols (list[str]): Stock symbols of interest.
 
         Returns:
-            requests.Response: Requests object returned by API.
+            dict: JSON returned by API, keyed by symbol.
         """
-        req = self._create_request(request_type='info', symbols=symbols, data_set=['company'])
-        data = self._send_request(req)
-        return data
+        return asyncio.run(self.get_symbol_info_async(symbols))
+
+    async def get_symbol_info_async(self, symbols: list[str], batch_session: tuple = None) -> dict:
+        """
+        Coroutine version of self.get_symbol_info(), to be gathered w/ other requests sharing one self._batch_session().
+        """
+        return await self._batch_request(request_type='info', symbols=symbols, data_set=self._INFO_TYPES,
+                                         batch_session=batch_session)
 
-    def get_stats(self, symbols: list[str]) -> Union[requests.Response, None]:
+    def get_stats(self, symbols: list[str]) -> dict:
         """
         Gets statistics for each symbol
 
@@ -54,19 +109,19 @@ class IEXApi():
             symbols (list[str]): Stock symbols of interest.
 
         Returns:
-            Union[requests.Response, None]: Requests object returned by API.
+            dict: JSON returned by API, keyed by symbol.
         """
-        # API should have < 100 symbols
-        if len(symbols) > 100:
-            self.logger.error(f"len(symbols) = {len(symbols)} > 100")
-            return None
+        return asyncio.run(self.get_stats_async(symbols))
 
-        req = self._create_request(request_type="stat",
-                                   symbols=symbols, data_set=["stats", "price"])
-        data = self._send_request(req)
-        return data
+    async def get_stats_async(self, symbols: list[str], batch_session: tuple = None) -> dict:
+        """
+        Coroutine version of self.get_stats(), to be gathered w/ other requests sharing one self._batch_session().
+        """
+        return await self._batch_request(request_type="stat",
+                                         symbols=symbols, data_set=self._STAT_TYPES,
+                                         batch_session=batch_session)
 
-    def get_advanced_stats(self, symbols: list[str]) -> Union[requests.Response, None]:
+    def get_advanced_stats(self, symbols: list[str]) -> dict:
         """
         Request advanced statistics given a list of symbols.
 
@@ -74,31 +129,94 @@ class IEXApi():
             symbols (list[str]): Stock symbols of interest.
 
         Returns:
-            Union[requests.Response, None]: Requests object returned by API.
+            dict: JSON returned by API, keyed by symbol.
         """
-        if len(symbols) > 100:
-            self.logger.error(f"len(symbols) = {len(symbols)} > 100")
-            return None
+        return asyncio.run(self.get_advanced_stats_async(symbols))
 
-        req = self._create_request(request_type="stat",
-                                   symbols=symbols, data_set=['advanced-stats'])
-        data = self._send_request(req)
-        return data
+    async def get_advanced_stats_async(self, symbols: list[str], batch_session: tuple = None) -> dict:
+        """
+        Coroutine version of self.get_advanced_stats(), to be gathered w/ other requests sharing one self._batch_session().
+        """
+        return await self._batch_request(request_type="stat",
+                                         symbols=symbols, data_set=self._ADV_STAT_TYPES,
+                                         batch_session=batch_session)
+
+    def get_stats_subset(self, symbols: list[str], fields: list[str]) -> dict:
+        """
+        Stream statistics for each symbol, only keeping the requested fields in memory.
+
+        Responses are parsed incrementally w/ ijson and bypass the on-disk cache.
+
+        Args:
+            symbols (list[str]): Stock symbols of interest.
+            fields (list[str]): Statistics to keep (e.g. month1ChangePercent, year1ChangePercent).
+
+        Returns:
+            dict: Column name to values, a symbol list and one float array per field (nan when missing).
+
+        Raises:
+            requests.HTTPError: If any chunk fails, rather than returning a partial set of symbols.
+        """
+        columns = {'symbol': [], **{field: array('d') for field in fields}}
+
+        for chunk in self._chunk_symbols_list(symbols, 100):
+            request = self._create_request(request_type="stat", symbols=chunk, data_set=self._SUBSET_TYPES)
+            path, params = request
+            self.logger.info(f"Sending Request - {self._request_url(request)}")
+
+            with self.session.get(path, params={**params, 'token': self.token}, stream=True) as data:
+                self.logger.info(f"Request Status Code - {data.status_code}")
+                self._raise_for_status(request, data)
+
+                data.raw.decode_content = True
+                targets = {}
+                for prefix, event, value in ijson.parse(data.raw, use_float=True):
+                    if prefix == '' and event == 'map_key':
+                        # new symbol, symbols may contain dots so match on full prefixes
+                        columns['symbol'].append(value)
+                        for field in fields:
+                            columns[field].append(float('nan'))
+                        targets = {f"{value}.{self._SUBSET_TYPES}.{field}": field for field in fields}
+                    elif event == 'number' and prefix in targets:
+                        columns[targets[prefix]][-1] = value
+
+        return columns
+
+    def get_peers(self, symbols: list[str]) -> dict:
+        """
+        Request the peers of each symbol.
+
+        Args:
+            symbols (list[str]): Stock symbols of interest.
+
+        Returns:
+            dict: JSON returned by API, keyed by symbol.
+        """
+        return asyncio.run(self.get_peers_async(symbols))
+
+    async def get_peers_async(self, symbols: list[str], batch_session: tuple = None) -> dict:
+        """
+        Coroutine version of self.get_peers(), to be gathered w/ other requests sharing one self._batch_session().
+        """
+        return await self._batch_request(request_type="stat",
+                                         symbols=symbols, data_set=self._PEER_TYPES,
+                                         batch_session=batch_session)
 
     # def get_sector_quotes(self, sector):
     #     req = self._create_request(sector=sector)
     #     data = self._send_request(req)
     #     return data
 
-    def get_sector_list(self) -> requests.Response:
+    def get_sector_list(self) -> list[dict]:
         """
         Request list of sectors from API.
 
         Returns:
-            requests.Response: Requests object returned by API.
+            list[dict]: JSON returned by API, one dict per sector.
         """
         req = self._create_request(request_type="sector_list")
-        data = self._send_request(req)
+        # sectors are near-static, keep them around for a day
+        data = self._send_request(req, expire_after=86400)
         return data
 
     # def stream_symbol(self, symbol):
@@ -109,77 +227,315 @@ class IEXApi():
     def _create_request(self,
                         request_type: str,
                         symbols: list[str] = None,
-                        data_set: list[str] = None,
+                        data_set: Union[list[str], str] = None,
                         custom: str = None,
                         *args, **kwargs
-                        ) -> str:
+                        ) -> tuple[str, dict]:
         """
-        Create the URL request to pass to self._send_request(), w/o the token.
+        Create the URL path and query parameters to pass to self._send_request(), w/o the token.
 
         This function serves at the catch all to interact with the API, and will essentially grow
         with usage.
 
         Args:
+            request_type (str): Type of request, one of self._builders (stat, info, sector_list).
             symbols (list, optional): Stock symbols to query. Defaults to None.
-            data_set (list, optional): Data set to query (e.g. advanced, stats, daily, etc). Defaults to None.
+            data_set (Union[list,str], optional): Data set to query (e.g. advanced, stats, daily, etc), may be pre-joined. Defaults to None.
             custom (str, optional): Custom URL request that overides the arguments. Defaults to None.
 
         Returns:
-            string: String of the URL request.
+            tuple[str, dict]: URL path of the request and its query parameters.
+
+        Raises:
+            NotImplementedError: If request_type is not supported.
+            TypeError: If symbols/data_set do not match the request_type.
         """
+        try:
+            builder = self._builders[request_type]
+        except KeyError:
+            raise NotImplementedError(f"Unknown request_type '{request_type}'") from None
 
+        return builder(symbols, data_set)
 
-        try:
-            if request_type == "stat" or request_type == "info":
-                # Some type checking to make sure that symbols is a list of symbols, since we are only using batch requests
-                if not isinstance(symbols,  list) or symbols  is None or \
-                   not isinstance(data_set, list) or data_set is None:
-                    raise TypeError
+    def _build_batch_url(self, symbols: list[str], data_set: Union[list[str], str]) -> tuple[str, dict]:
+        """
+        Create a batch request for several symbols and data sets.
+
+        Args:
+            symbols (list[str]): Stock symbols to query.
+            data_set (Union[list[str],str]): Data set to query, may be pre-joined.
+
+        Returns:
+            tuple[str, dict]: URL path of the request and its query parameters.
+        """
+        # Some type checking to make sure that symbols is a list of symbols, since we are only using batch requests
+        if not isinstance(symbols, list) or not isinstance(data_set, (list, str)):
+            raise TypeError(f"Batch requests need a list of symbols and a data_set, "
+                            f"got {type(symbols).__name__} and {type(data_set).__name__}")
+
+        if isinstance(data_set, list):
+            data_set = ','.join(data_set)
+        params = {'symbols': ','.join(symbols), 'types': data_set}
+        return f"{self.base_url}/stable/stock/market/batch", params
+
+    def _build_sector_url(self, symbols: list[str] = None, data_set: Union[list[str], str] = None) -> tuple[str, dict]:
+        """
+        Create the request for the list of sectors, symbols and data_set are ignored.
+
+        Returns:
+            tuple[str, dict]: URL path of the request and its query parameters.
+        """
+        return f"{self.base_url}/stable/ref-data/sectors", {}
 
-                else:
-                    joined_data_set = ','.join(data_set) 
-                    joined_symbols = ','.join(symbols)
-                    return f"{self.base_url}/stable/stock/market/batch?symbols={joined_symbols}&types={joined_data_set}&"
+    async def _batch_request(self,
+                             request_type: str,
+                             symbols: list[str],
+                             data_set: Union[list[str], str],
+                             batch_session: tuple = None) -> dict:
+        """
+        Send one batch request per chunk of <= 100 symbols and merge the results.
 
-            # elif sector is not None:
-                # batch_api_call_url = f"{self.base_url}/stable/stock/market/collection/sector?collectionName={sector}&"
+        Args:
+            request_type (str): Type of request passed to self._create_request().
+            symbols (list[str]): Stock symbols of interest.
+            data_set (Union[list[str],str]): Data set to query (e.g. advanced-stats, stats, company, etc).
+            batch_session (tuple, optional): Session and semaphore from self._batch_session(). Defaults to None, opening a new one.
 
-            # elif sector_list is not None and sector_list:
-            #     batch_api_call_url = f"{self.base_url}/stable/ref-data/sectors?"
+        Returns:
+            dict: Merged JSON of every chunk, keyed by symbol.
+        """
+        if isinstance(data_set, list):
+            data_set = ','.join(data_set)
 
-            elif request_type == "sector_list":
-                return f"{self.base_url}/stable/ref-data/sectors?"
-            else:
-                raise NotImplementedError
+        requests_list = [self._create_request(request_type=request_type, symbols=chunk, data_set=data_set)
+                         for chunk in self._chunk_symbols_list(symbols, 100)]
+        responses = await self._send_request_batch(requests_list, batch_session)
 
-        except Exception as e:
-            self.logger.error(f"Received Error {e}", exc_info=True)
-            return "fuck off"
+        merged = {}
+        for data in responses:
+            merged.update(data)
+        return merged
 
-    def _send_request(self, request: str) -> requests.Response:
+    def _send_request(self, request: tuple[str, dict], expire_after: int = 3600) -> Union[dict, list]:
         """
-        Sends request to IEX API
+        Sends request to IEX API, unless a fresh response is cached on disk.
 
         Args:
-            request (str): Raw string to be send directly to API
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+            expire_after (int, optional): Seconds a cached response stays valid. Defaults to 3600.
 
         Returns:
-            requests.Response : Request object containing the results.
+            Union[dict, list]: JSON returned by API.
         """
-        request += f"token={self.token}"
-        self.logger.info(f"Sending Request - {request}")
-        data = requests.get(request)
+        data = self._cache_get(request, expire_after)
+        if data is not None:
+            return data
+
+        path, params = request
+        self.logger.info(f"Sending Request - {self._request_url(request)}")
+        data = self.session.get(path, params={**params, 'token': self.token})
 
         self.logger.info(f"Request Status Code - {data.status_code}")
+        self._raise_for_status(request, data)
+
+        # only the decoded body is cached, the Response still holds the token in its url
+        data = orjson.loads(data.content)
+        self._cache_set(request, data)
         return data
 
-    def _chunk_symbols_list(self, symbols, n):
+    def _raise_for_status(self, request: tuple[str, dict], data: requests.Response) -> None:
         """
-        Chunk list of symbols into groups of 100 to help w/ API performance.
+        Raise on an error status, w/o the token in the message (unlike requests.Response.raise_for_status).
 
         Args:
-            symbols (list): List of strings, each string is a symbol/ticker
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+            data (requests.Response): Response of the request.
+
+        Raises:
+            requests.HTTPError: If the status code is 4xx/5xx.
+        """
+        if data.status_code >= 400:
+            raise requests.HTTPError(f"{data.status_code} Error: {data.reason} for url: {self._request_url(request)}",
+                                     response=data)
+
+    async def _fetch(self,
+                     session: aiohttp.ClientSession,
+                     semaphore: asyncio.Semaphore,
+                     request: tuple[str, dict],
+                     expire_after: int = 3600) -> dict:
         """
+        Sends a single request to IEX API within an open session, unless a fresh response is cached on disk.
+
+        Rate limited (429) requests are retried after the delay given by the Retry-After header.
+
+        Args:
+            session (aiohttp.ClientSession): Session shared by the batch of requests.
+            semaphore (asyncio.Semaphore): Limits the number of requests in flight.
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+            expire_after (int, optional): Seconds a cached response stays valid. Defaults to 3600.
 
-        for i in range(0, len(symbols), n):
-            yield symbols[i:i+n]
+        Returns:
+            dict: JSON returned by API.
+        """
+        data = self._cache_get(request, expire_after)
+        if data is not None:
+            return data
+
+        path, params = request
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                self.logger.info(f"Sending Request - {self._request_url(request)}")
+                async with session.get(path, params={**params, 'token': self.token}) as resp:
+                    self.logger.info(f"Request Status Code - {resp.status}")
+                    if resp.status != 429 or attempt == self.max_retries:
+                        self._raise_for_status_async(request, resp)
+                        data = orjson.loads(await resp.read())
+                        break
+                    delay = self._retry_after(resp.headers)
+
+                self.logger.warning(f"Rate limited, retrying in {delay}s ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(delay)
+
+        if resp.status == 200:
+            self._cache_set(request, data)
+        return data
+
+    def _raise_for_status_async(self, request: tuple[str, dict], resp: aiohttp.ClientResponse) -> None:
+        """
+        Raise on an error status, w/o the token in the message (unlike aiohttp.ClientResponse.raise_for_status).
+
+        Args:
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+            resp (aiohttp.ClientResponse): Response of the request.
+
+        Raises:
+            aiohttp.ClientResponseError: If the status code is 4xx/5xx.
+        """
+        if resp.status >= 400:
+            url = yarl.URL(self._request_url(request))
+            request_info = aiohttp.RequestInfo(url, resp.method, resp.request_info.headers, url)
+            raise aiohttp.ClientResponseError(request_info, resp.history, status=resp.status,
+                                              message=resp.reason, headers=resp.headers)
+
+    def _retry_after(self, headers) -> float:
+        """
+        Seconds to wait before retrying a rate limited request.
+
+        Args:
+            headers (Mapping[str, str]): Headers of the 429 response.
+
+        Returns:
+            float: Value of the Retry-After header, 1 second if missing or not a number of seconds.
+        """
+        try:
+            return max(float(headers.get('Retry-After', 1)), 0.0)
+        except ValueError:
+            return 1.0
+
+    def _request_url(self, request: tuple[str, dict]) -> str:
+        """
+        Full URL of the request w/o the token, used for logging and caching.
+
+        Args:
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+
+        Returns:
+            str: URL of the request.
+        """
+        path, params = request
+        return f"{path}?{urlencode(sorted(params.items()))}"
+
+    def _cache_key(self, request: tuple[str, dict]) -> str:
+        """
+        Hash the request w/o the token, so the token never ends up in the on-disk cache keys.
+
+        Args:
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+
+        Returns:
+            str: Key of the request in the cache.
+        """
+        return hashlib.md5(self._request_url(request).encode()).hexdigest()
+
+    def _cache_get(self, request: tuple[str, dict], expire_after: int):
+        """
+        Look up a response in the on-disk cache.
+
+        Args:
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+            expire_after (int): Seconds a cached response stays valid.
+
+        Returns:
+            Cached response, or None if caching is disabled, missing or stale.
+        """
+        if self.cache_path is None:
+            return None
+
+        with shelve.open(self.cache_path) as cache:
+            entry = cache.get(self._cache_key(request))
+
+        if entry is None:
+            return None
+
+        stored_at, data = entry
+        if time.time() - stored_at > expire_after:
+            return None
+
+        self.logger.info(f"Loaded Cached Response - {self._request_url(request)}")
+        return data
+
+    def _cache_set(self, request: tuple[str, dict], data) -> None:
+        """
+        Store a response in the on-disk cache.
+
+        Args:
+            request (tuple[str, dict]): URL path and query parameters from self._create_request()
+            data (Union[dict, list]): Decoded JSON to store, never the Response itself.
+        """
+        if self.cache_path is None:
+            return
+
+        with shelve.open(self.cache_path) as cache:
+            cache[self._cache_key(request)] = (time.time(), data)
+
+    @asynccontextmanager
+    async def _batch_session(self):
+        """
+        Open the session and semaphore shared by concurrent requests, so at most self.max_concurrency are in flight.
+
+        Yields:
+            tuple[aiohttp.ClientSession, asyncio.Semaphore]: Session and semaphore to pass to self._send_request_batch().
+        """
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            yield session, asyncio.Semaphore(self.max_concurrency)
+
+    async def _send_request_batch(self, requests_list: list[tuple[str, dict]], batch_session: tuple = None) -> list[dict]:
+        """
+        Sends several requests to IEX API concurrently, at most self.max_concurrency at once.
+
+        Args:
+            requests_list (list[tuple[str, dict]]): URL paths and query parameters from self._create_request()
+            batch_session (tuple, optional): Session and semaphore from self._batch_session(). Defaults to None, opening a new one.
+
+        Returns:
+            list[dict]: JSON returned by API for each request, in the same order.
+        """
+        if batch_session is None:
+            async with self._batch_session() as batch_session:
+                return await self._send_request_batch(requests_list, batch_session)
+
+        session, semaphore = batch_session
+        return await asyncio.gather(*[self._fetch(session, semaphore, req) for req in requests_list])
+
+    def _chunk_symbols_list(self, symbols, n):
+        """
+        Chunk symbols into groups of n (at most 100 per batch request) to help w/ API performance.
+
+        Args:
+            symbols (Iterable[str]): Symbols/tickers, any iterable is consumed lazily.
+            n (int): Maximum number of symbols per chunk.
+        """
+        symbols = iter(symbols)
+        while chunk := list(islice(symbols, n)):
+            yield chunk